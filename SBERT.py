@@ -5,7 +5,10 @@ from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, classification_report
 import numpy as np
-from tqdm import tqdm
+import torch
+
+torch.set_float32_matmul_precision('high')
+torch.backends.cudnn.allow_tf32 = True
 
 print("Loading 20newsgroups dataset")
 dataset = fetch_20newsgroups(subset="all", shuffle=True, remove=("headers", "footers", "quotes"))
@@ -26,6 +29,8 @@ print(f"Train size: {len(train_texts)}, Test size: {len(test_texts)}")
 
 # 3. Load a pretrained Sentence Transformer model
 model = SentenceTransformer("all-MiniLM-L6-v2")
+# MiniLM-L6 was trained at 128 tokens; longer inputs only cost attention FLOPs
+model.max_seq_length = 128
 
 train_subset_size = 2000
 test_subset_size = 400
@@ -36,56 +41,76 @@ test_texts_subset = test_texts[:test_subset_size]
 test_labels_subset = test_labels[:test_subset_size]
 
 print("\n=== Creating training pairs for fine-tuning ===")
-train_examples = []
-
 num_pairs = 1000
-for _ in tqdm(range(num_pairs), desc="Creating pairs"):
-    idx1, idx2 = np.random.choice(len(train_texts_subset), 2, replace=False)
-    while train_labels_subset[idx1] != train_labels_subset[idx2]:
-        idx1, idx2 = np.random.choice(len(train_texts_subset), 2, replace=False)
-
-    train_examples.append(InputExample(texts=[str(train_texts_subset[idx1]), str(train_texts_subset[idx2])], label=1.0))
-
-    idx1, idx2 = np.random.choice(len(train_texts_subset), 2, replace=False)
-    while train_labels_subset[idx1] == train_labels_subset[idx2]:
-        idx1, idx2 = np.random.choice(len(train_texts_subset), 2, replace=False)
-
-    train_examples.append(InputExample(texts=[str(train_texts_subset[idx1]), str(train_texts_subset[idx2])], label=0.0))
+rng = np.random.default_rng()
+
+# indices grouped by class: class c occupies sorted_idx[class_starts[c]:class_starts[c] + class_sizes[c]]
+sorted_idx = np.argsort(train_labels_subset, kind="stable")
+class_sizes = np.bincount(train_labels_subset, minlength=num_classes)
+class_starts = np.concatenate(([0], np.cumsum(class_sizes)[:-1]))
+
+# positives: pick a class weighted by its number of same-label pairs, then two distinct members of it
+pair_counts = class_sizes * (class_sizes - 1)
+pos_classes = rng.choice(num_classes, size=num_pairs, p=pair_counts / pair_counts.sum())
+pos_sizes = class_sizes[pos_classes]
+pos_first = rng.integers(pos_sizes)
+pos_second = (pos_first + 1 + rng.integers(pos_sizes - 1)) % pos_sizes
+pos_idx1 = sorted_idx[class_starts[pos_classes] + pos_first]
+pos_idx2 = sorted_idx[class_starts[pos_classes] + pos_second]
+
+train_examples = [
+    InputExample(texts=[train_texts_subset[idx1], train_texts_subset[idx2]])
+    for idx1, idx2 in zip(pos_idx1, pos_idx2)
+]
 
 print("\nFine-tuning SBERT Model")
-train_dataloader = DataLoader(train_examples, shuffle=True, batch_size=16)
-train_loss = losses.CosineSimilarityLoss(model)
+# other in-batch positives serve as negatives, so larger batches give more of them
+train_dataloader = DataLoader(train_examples, shuffle=True, batch_size=64)
+train_loss = losses.MultipleNegativesRankingLoss(model)
 
 model.fit(
     train_objectives=[(train_dataloader, train_loss)],
     epochs=1,
-    warmup_steps=100,
+    warmup_steps=len(train_dataloader) // 10,
     show_progress_bar=True
 )
 
 print("Fine-tuning completed!")
 
-print("\nGenerating embeddings for classification")
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-print("Encoding training texts...")
-train_embeddings = model.encode(
-    [str(text) for text in train_texts_subset],
-    show_progress_bar=True,
-    convert_to_numpy=True
-)
+print("\nGenerating embeddings for classification")
 
-print("Encoding test texts...")
-test_embeddings = model.encode(
-    [str(text) for text in test_texts_subset],
-    show_progress_bar=True,
-    convert_to_numpy=True
-)
+with torch.inference_mode(), torch.autocast(device, dtype=torch.float16, enabled=device == 'cuda'):
+    print("Encoding training texts...")
+    train_embeddings = model.encode(
+        train_texts_subset,
+        batch_size=256,
+        device=device,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=True
+    )
+
+    print("Encoding test texts...")
+    test_embeddings = model.encode(
+        test_texts_subset,
+        batch_size=256,
+        device=device,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=True
+    )
+
+# guarantee C-ordered float32 input, which saga consumes without a copy
+train_embeddings = np.ascontiguousarray(train_embeddings, dtype=np.float32)
+test_embeddings = np.ascontiguousarray(test_embeddings, dtype=np.float32)
 
 print(f"Train embeddings shape: {train_embeddings.shape}")
 print(f"Test embeddings shape: {test_embeddings.shape}")
 
 print("\nTraining Logistic Regression Classifier")
-classifier = LogisticRegression(max_iter=1000, random_state=42, verbose=1)
+classifier = LogisticRegression(solver='saga', max_iter=200, tol=1e-3, random_state=42, verbose=1)
 classifier.fit(train_embeddings, train_labels_subset)
 
 print("\nTesting SBERT Model")
@@ -110,7 +135,9 @@ test_sentences = [
     "New graphics card released with improved performance.",
 ]
 
-test_sentence_embeddings = model.encode(test_sentences)
+with torch.inference_mode(), torch.autocast(device, dtype=torch.float16, enabled=device == 'cuda'):
+    test_sentence_embeddings = model.encode(test_sentences, device=device, normalize_embeddings=True)
+test_sentence_embeddings = np.ascontiguousarray(test_sentence_embeddings, dtype=np.float32)
 predictions = classifier.predict(test_sentence_embeddings)
 
 for sentence, pred in zip(test_sentences, predictions):